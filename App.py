@@ -1,8 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
 import re
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
+from pathlib import Path
+
+try:
+    from rapidfuzz import fuzz, process as fuzz_process
+except ImportError:  # optional: without it only exact well keys are matched
+    fuzz_process = None
 
 # -----------------------------------------------------------------------------
 # 1. APP CONFIGURATION & STYLING
@@ -14,76 +23,161 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Custom CSS
-st.markdown("""
-    <style>
-    .main { background-color: #f9f9f9; }
-    .stButton>button {
-        width: 100%;
-        background-color: #0068c9;
-        color: white;
-        font-weight: bold;
-        border-radius: 8px;
-        height: 3em;
-    }
-    .stButton>button:hover { background-color: #004b91; color: white; }
-    div[data-testid="stMetricValue"] { font-size: 1.2rem; }
-    h1 { color: #0f2937; }
-    h2, h3 { color: #0068c9; }
-    </style>
-""", unsafe_allow_html=True)
+# Custom CSS (kept in .streamlit/style.css; read from disk once per process)
+@st.cache_resource
+def load_css():
+    """Reads the app stylesheet."""
+    return (Path(__file__).parent / ".streamlit" / "style.css").read_text(encoding="utf-8")
+
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
 
 
 # -----------------------------------------------------------------------------
 # 2. CORE LOGIC (HELPER FUNCTIONS)
 # -----------------------------------------------------------------------------
 
-@st.cache_data(show_spinner=False)
+# Daily Report column -> header synonyms, checked in order
+TARGET_COLUMNS = {
+    'well_name': ['well no', 'well name', 'well', 'name'],
+    'whfp': ['whfp', 'tubing pressure', 'whp', 'thp'],
+    'choke': ['choke', '/64', 'bean'],
+    'flp': ['flp', 'flowline', 'line press'],
+    'prod_time': ['prod. time', 'hours', 'on stream', 'runtime', 'duration', 'time'],
+    'gas': ['raw gas', 'gas rate', 'mmscfd', 'gas'],
+    'condensate': ['raw cond', 'condensate', 'bbl/d', 'cond', 'oil'],
+    'water': ['raw water', 'water rate', 'wc', 'water'],
+    'salinity': ['salinity', 'ppm', 'salt']
+}
+HEADER_TERMS = [t for sub in TARGET_COLUMNS.values() for t in sub]
+# One alternation per column, compiled once instead of on every upload
+COLUMN_PATTERNS = {
+    key: re.compile('|'.join(map(re.escape, synonyms)))
+    for key, synonyms in TARGET_COLUMNS.items()
+}
+# Runs of separators, turned into spaces so fuzzy scoring sees word tokens
+NAME_SEPARATORS = re.compile(r'[\W_]+')
+# Words of a spaced well name that carry its number ('12a' in 'well 12a')
+WELL_NUMBER_PATTERN = re.compile(r'\w*\d\w*')
+
+# Master Sheet parameter fragment -> source column, checked in priority order
+PARAM_SOURCE_COLUMNS = (
+    ('whfp', 'whfp'),
+    ('choke', 'choke'),
+    ('flp', 'flp'),
+    ('gas', 'gas'),
+    ('cond', 'condensate'),
+    ('water', 'water'),
+    ('time', 'prod_time'),
+    ('hours', 'prod_time'),
+    ('duration', 'prod_time'),
+    ('salin', 'salinity'),
+)
+
+@lru_cache(maxsize=4096)
+def _normalize_cached(text):
+    """normalize_text for a plain str; well and parameter names repeat a lot."""
+    # str.isalnum is exactly the complement of [\W_], minus the regex engine.
+    return ''.join(filter(str.isalnum, text.lower()))
+
 def normalize_text(text):
     """Standardizes text for comparison."""
     if pd.isna(text) or text == "":
         return ""
-    text = str(text).lower()
-    return re.sub(r'[\W_]+', '', text)
+    return _normalize_cached(str(text))
+
+def normalize_series(values):
+    """normalize_text over a whole column."""
+    values = pd.Series(values)
+    # One pass over the column; repeated labels hit the lru_cache
+    keys = [normalize_text(text) for text in values.tolist()]
+    return pd.Series(keys, index=values.index, dtype=object)
+
+@lru_cache(maxsize=256)
+def classify_param(param_key):
+    """Maps a normalized parameter name to its source column (or None)."""
+    return next((col for frag, col in PARAM_SOURCE_COLUMNS if frag in param_key), None)
+
+def fuzzy_text(name):
+    """Lowercases a well name and splits it into space-separated words."""
+    return NAME_SEPARATORS.sub(' ', str(name).lower()).strip()
+
+def well_shape(text):
+    """The number words and the word count of a fuzzy_text well name."""
+    return sorted(WELL_NUMBER_PATTERN.findall(text)), len(text.split())
+
+def fuzzy_match_wells(target_names, source_names):
+    """Pairs template wells with no exact match to their closest source well.
+
+    Both arguments map well key -> well name as written in the sheet.
+    Returns (template key, source key, score) tuples.
+    """
+    if fuzz_process is None:
+        return []
+    # Same number words and no extra words: 'Salam-2' never takes 'Salam-2 ST'
+    candidates = {key: fuzzy_text(name) for key, name in source_names.items()}
+    pairs = []
+    for key, name in target_names.items():
+        text = fuzzy_text(name)
+        shape = well_shape(text)
+        choices = {k: t for k, t in candidates.items() if well_shape(t) == shape}
+        best = fuzz_process.extract(text, choices, scorer=fuzz.token_sort_ratio, limit=2)
+        if not best or best[0][1] < 85:
+            continue
+        if len(best) > 1 and best[0][1] - best[1][1] < 5:
+            continue  # two candidates about as close: too ambiguous to pick one
+        pairs.append((key, best[0][2], best[0][1]))
+        del candidates[best[0][2]]
+    return pairs
+
+def read_raw_sheet(data, name):
+    """Reads uploaded CSV/Excel bytes as-is, without a header row."""
+    if name.endswith('.csv'):
+        try:
+            # pyarrow returns None for empty text cells; turn them back into NaN
+            df = pd.read_csv(io.BytesIO(data), header=None, engine='pyarrow')
+            return df.fillna(np.nan)
+        except (ImportError, ValueError):
+            # pyarrow not installed, or a ragged file it refuses: use the C parser
+            return pd.read_csv(io.BytesIO(data), header=None)
+    try:
+        # python-calamine parses xlsx/xls natively, several times faster than openpyxl
+        return pd.read_excel(io.BytesIO(data), header=None, engine='calamine')
+    except (ImportError, ValueError):
+        # calamine not installed (or pandas < 2.2): use the default engine
+        return pd.read_excel(io.BytesIO(data), header=None)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def read_template(data, name):
+    """read_raw_sheet for the Master Sheet, cached on the file contents."""
+    return read_raw_sheet(data, name)
 
 def find_header_row(df, key_terms):
     """Finds the row index that looks most like a header."""
-    df_str = df.astype(str).apply(lambda x: x.str.lower())
+    head = df.iloc[:20]
     best_idx = None
     max_matches = 0
     
-    for idx, row in df_str.iloc[:20].iterrows():
-        matches = sum(1 for term in key_terms if row.str.contains(term, regex=False).any())
+    # One joined string per row; each term is then a single substring test
+    for idx, row in zip(head.index, head.to_numpy()):
+        text = '\n'.join(map(str, row)).lower()
+        matches = sum(1 for term in key_terms if term in text)
         if matches > max_matches:
             max_matches = matches
             best_idx = idx
-            
+            if max_matches == len(key_terms):
+                break  # no later row can beat a row that hits every term
+    
     return best_idx if max_matches >= 2 else None
 
-def extract_production_data(file):
+@st.cache_data(show_spinner=False, max_entries=8)
+def extract_production_data(data, name):
     """Extracts data from the Daily Report (Source)."""
     try:
-        if file.name.endswith('.csv'):
-            df_raw = pd.read_csv(file, header=None)
-        else:
-            df_raw = pd.read_excel(file, header=None)
+        df_raw = read_raw_sheet(data, name)
     except Exception as e:
         return None, f"Error reading file: {e}"
 
-    target_columns = {
-        'well_name': ['well no', 'well name', 'well', 'name'],
-        'whfp': ['whfp', 'tubing pressure', 'whp', 'thp'],
-        'choke': ['choke', '/64', 'bean'],
-        'flp': ['flp', 'flowline', 'line press'],
-        'prod_time': ['prod. time', 'hours', 'on stream', 'runtime', 'duration', 'time'],
-        'gas': ['raw gas', 'gas rate', 'mmscfd', 'gas'],
-        'condensate': ['raw cond', 'condensate', 'bbl/d', 'cond', 'oil'],
-        'water': ['raw water', 'water rate', 'wc', 'water'],
-        'salinity': ['salinity', 'ppm', 'salt']
-    }
-    
-    all_terms = [t for sub in target_columns.values() for t in sub]
-    header_idx = find_header_row(df_raw, all_terms)
+    header_idx = find_header_row(df_raw, HEADER_TERMS)
     
     if header_idx is None:
         return None, "Could not detect a valid header row. Check file format."
@@ -91,117 +185,152 @@ def extract_production_data(file):
     # Handle 2-Row Header (Row 1: "Prod.", Row 2: "Time")
     is_multi_row = False
     if header_idx + 1 < len(df_raw):
-        row2_str = df_raw.iloc[header_idx + 1].astype(str).str.lower().str.cat()
-        if any(x in row2_str for x in ['gas', 'bbl', 'time', 'water']):
-            is_multi_row = True
+        # Look for the hints cell by cell
+        cells = set(map(str.lower, df_raw.iloc[header_idx + 1].to_numpy(dtype=str)))
+        is_multi_row = any(x in c for c in cells for x in ('gas', 'bbl', 'time', 'water'))
 
     if is_multi_row:
         r1 = df_raw.iloc[header_idx].astype(str).replace('nan', '')
         r2 = df_raw.iloc[header_idx + 1].astype(str).replace('nan', '')
         df_raw.columns = (r1 + " " + r2).str.strip().str.lower()
-        df_data = df_raw.iloc[header_idx + 2:].reset_index(drop=True)
+        body_start = header_idx + 2
     else:
         df_raw.columns = df_raw.iloc[header_idx].astype(str).str.strip().str.lower()
-        df_data = df_raw.iloc[header_idx + 1:].reset_index(drop=True)
+        body_start = header_idx + 1
 
+    # Keep only the first of any repeated header so every lookup is a Series
+    if df_raw.columns.has_duplicates:
+        df_raw = df_raw.loc[:, ~df_raw.columns.duplicated()]
+    # A row slice is a view; the body index is never used, so don't renumber it
+    df_data = df_raw.iloc[body_start:]
+
+    # Each target column's pattern runs over all headers at once
+    columns = pd.Index(df_data.columns)
     extracted_data = {}
-    for key, synonyms in target_columns.items():
-        found_col = None
-        for col in df_data.columns:
-            if any(syn in col for syn in synonyms):
-                found_col = col
-                break
+    for key, pattern in COLUMN_PATTERNS.items():
+        hits = columns[columns.str.contains(pattern, regex=True, na=False)]
+        found_col = hits[0] if len(hits) else None
         
         if found_col:
-            col_data = df_data[found_col]
-            if isinstance(col_data, pd.DataFrame):
-                col_data = col_data.iloc[:, 0]
-            extracted_data[key] = col_data
+            extracted_data[key] = df_data[found_col]
         else:
             extracted_data[key] = [None] * len(df_data)
 
     final_df = pd.DataFrame(extracted_data)
     final_df = final_df.dropna(subset=['well_name'])
-    final_df = final_df[~final_df['well_name'].astype(str).str.lower().str.contains('well', na=False)]
-    final_df['well_key'] = final_df['well_name'].apply(normalize_text)
+    final_df['well_key'] = normalize_series(final_df['well_name'])
+    # Drop repeated "Well ..." caption rows; the key is already lowercased
+    final_df = final_df[~final_df['well_key'].str.contains('well', regex=False)]
     
     return final_df, None
 
-def process_and_match(template_file, source_df, report_date):
+def process_and_match(template_data, template_name, source_df, report_date):
     """Matches data to the Master History Sheet."""
     try:
-        if template_file.name.endswith('.csv'):
-            df_tmpl = pd.read_csv(template_file, header=None)
-        else:
-            df_tmpl = pd.read_excel(template_file, header=None)
+        df_tmpl = read_template(template_data, template_name)
     except Exception as e:
-        return None, None, None, f"Error reading Master Sheet: {e}"
+        return None, None, None, None, None, f"Error reading Master Sheet: {e}"
 
     param_keywords = ['whfp', 'gas rate', 'choke', 'flp', 'condensate']
     param_row_idx = find_header_row(df_tmpl, param_keywords)
     
     if param_row_idx is None:
-        return None, None, None, "Could not find parameter row (WHFP, Gas Rate) in Master Sheet."
+        return None, None, None, None, None, "Could not find parameter row (WHFP, Gas Rate) in Master Sheet."
     
     well_row_idx = param_row_idx - 1
     if well_row_idx < 0:
-        return None, None, None, "Found parameters on Row 1, but expected Well Names above it."
+        return None, None, None, None, None, "Found parameters on Row 1, but expected Well Names above it."
 
-    well_row = df_tmpl.iloc[well_row_idx]
-    param_row = df_tmpl.iloc[param_row_idx]
+    # Both header rows as plain str arrays
+    well_vals = pd.Series(df_tmpl.iloc[well_row_idx].to_numpy(dtype=str))
+    param_vals = df_tmpl.iloc[param_row_idx].to_numpy(dtype=str).tolist()
+    param_keys = normalize_series(param_vals).tolist()
     
-    new_row = [None] * len(df_tmpl.columns)
+    new_row = np.full(len(df_tmpl.columns), None, dtype=object)
     
     # Date logic: Ensure it's a string to prevent PyArrow Date/String mismatch errors
     date_col_idx = 0 
     for i in range(len(df_tmpl.columns)):
-        if "date" in str(param_row.iloc[i]).lower():
+        if "date" in param_vals[i].lower():
             date_col_idx = i
             break
     
     # Use formatted string for date to avoid type conflicts
     new_row[date_col_idx] = report_date.strftime('%Y-%m-%d')
     
-    current_well_key = None
-    matched_wells = set()
-    target_wells_debug = []
+    # Forward-fill each merged-cell well name across its parameter columns
+    is_label = ~(well_vals.str.lower().eq('nan') | well_vals.str.strip().eq(''))
+    is_label.iloc[date_col_idx] = False
+    label_keys = normalize_series(well_vals).where(is_label, None)
+    well_keys = label_keys.ffill().fillna('').to_numpy(dtype=object)
+    labels = list(zip(well_vals[is_label], label_keys[is_label]))
 
-    for i in range(0, len(df_tmpl.columns)):
-        if i == date_col_idx: continue
+    # Locate each column's source row by well key (first row wins on duplicates)
+    source_rows = source_df.drop_duplicates('well_key')
+    source_keys = pd.Index(source_rows['well_key'])
+    row_pos = source_keys.get_indexer(well_keys)
+    
+    # Exact keys first; only wells left over on both sides go to the fuzzy search
+    missing = set(well_keys[(row_pos < 0) & (well_keys != '')])
+    target_names = {}
+    for val, key in labels:
+        if key in missing:
+            target_names.setdefault(key, val)
+    claimed = set(row_pos[row_pos >= 0].tolist())
+    source_names = {key: name for pos, (key, name)
+                    in enumerate(zip(source_rows['well_key'], source_rows['well_name']))
+                    if pos not in claimed}
+    fuzzy = {}
+    fuzzy_matches = []
+    for tmpl_key, src_key, score in fuzzy_match_wells(target_names, source_names):
+        row_pos[well_keys == tmpl_key] = source_keys.get_loc(src_key)
+        fuzzy[tmpl_key] = f" ~ {source_names[src_key]} (fuzzy {score:.0f}%)"
+        fuzzy_matches.append((target_names[tmpl_key], source_names[src_key], round(score)))
+    # Fuzzy substitutions are spelled out so the user can check each one
+    target_wells_debug = [f"{val} -> {key}{fuzzy.get(key, '')}" for val, key in labels]
 
-        val = str(well_row.iloc[i])
-        if val and val.lower() != 'nan' and val.strip() != '':
-            current_well_key = normalize_text(val)
-            target_wells_debug.append(f"{val} -> {current_well_key}")
-        
-        if not current_well_key:
-            continue
-            
-        param_val = str(param_row.iloc[i])
-        param_key = normalize_text(param_val)
-        
-        source_col = None
-        if 'whfp' in param_key: source_col = 'whfp'
-        elif 'choke' in param_key: source_col = 'choke'
-        elif 'flp' in param_key: source_col = 'flp'
-        elif 'gas' in param_key: source_col = 'gas'
-        elif 'cond' in param_key: source_col = 'condensate'
-        elif 'water' in param_key: source_col = 'water'
-        elif 'time' in param_key or 'hours' in param_key or 'duration' in param_key: source_col = 'prod_time'
-        elif 'salin' in param_key: source_col = 'salinity'
-        
-        if source_col:
-            match = source_df[source_df['well_key'] == current_well_key]
-            if not match.empty:
-                val = match.iloc[0][source_col]
-                if pd.notna(val):
-                    new_row[i] = val
-                    matched_wells.add(current_well_key)
-
-    new_row_df = pd.DataFrame([new_row], columns=df_tmpl.columns)
-    final_df = pd.concat([df_tmpl, new_row_df], ignore_index=True)
+    # Gather values field by field for every column that maps to that field
+    fields = np.array([classify_param(k) for k in param_keys], dtype=object)
+    
+    wanted = (row_pos >= 0) & (well_keys != '') & pd.notna(fields)
+    wanted[date_col_idx] = False
+    values = np.full(len(fields), None, dtype=object)
+    for field in set(fields[wanted]):
+        sel = wanted & (fields == field)
+        values[sel] = source_rows[field].to_numpy(dtype=object)[row_pos[sel]]
+    found = wanted & pd.notna(values)
+    new_row[found] = values[found]
+    matched_wells = set(well_keys[found])
+
+    # Returned separately; callers write it directly below df_tmpl
+    new_row_df = pd.DataFrame(new_row[np.newaxis], columns=df_tmpl.columns, index=[len(df_tmpl)])
     
-    return final_df, list(matched_wells), target_wells_debug, None
+    return df_tmpl, new_row_df, list(matched_wells), target_wells_debug, fuzzy_matches, None
+
+def write_history_excel(df_tmpl, new_row_df):
+    """Streams the Master Sheet plus the new row into xlsx bytes."""
+    # constant_memory needs rows written in order, so they are written here, not by to_excel
+    options = {
+        'constant_memory': True,
+        'strings_to_numbers': False,
+        'strings_to_formulas': False,
+        'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+    }
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='xlsxwriter', engine_kwargs={'options': options}) as writer:
+        sheet = writer.book.add_worksheet('Daily Production')
+        # Blank out NaN one block of rows at a time
+        blocks = chain((df_tmpl.iloc[i:i + 1024] for i in range(0, len(df_tmpl), 1024)),
+                       [new_row_df])
+        r = 0
+        for block in blocks:
+            cells = block.to_numpy(dtype=object)
+            cells[pd.isna(cells)] = None
+            for row in cells.tolist():
+                sheet.write_row(r, 0, row)
+                r += 1
+    
+    return buffer.getvalue()
 
 
 # -----------------------------------------------------------------------------
@@ -243,18 +372,21 @@ if source_file and template_file:
     if st.button("🚀 Process & Update History"):
         
         with st.status("Processing Data...", expanded=True) as status:
-            st.write("Extracting Daily Report...")
-            source_df, error_msg = extract_production_data(source_file)
+            # The label shows the running phase; results are written once at the end
+            status.update(label="Extracting Daily Report...")
+            source_df, error_msg = extract_production_data(source_file.getvalue(), source_file.name)
             
             if error_msg:
                 status.update(label="Extraction Failed", state="error")
                 st.error(error_msg)
                 st.stop()
                 
-            st.write(f"✅ Extracted **{len(source_df)} wells**.")
-            st.write("Matching to Master Sheet...")
-            final_df, matched, target_wells_debug, match_err = process_and_match(template_file, source_df, report_date)
+            log = [f"✅ Extracted **{len(source_df)} wells**."]
+            status.update(label="Matching to Master Sheet...")
+            df_tmpl, new_row_df, matched, target_wells_debug, fuzzy_matches, match_err = process_and_match(
+                template_file.getvalue(), template_file.name, source_df, report_date)
             
+            st.write("\n\n".join(log))
             if match_err:
                 status.update(label="Matching Failed", state="error")
                 st.error(match_err)
@@ -273,6 +405,9 @@ if source_file and template_file:
             st.error("⚠️ 0 Matches Found. Check 'Diagnostics' tab.")
         else:
             st.success(f"Ready to update for **{report_date.strftime('%Y-%m-%d')}**")
+        
+        if fuzzy_matches:
+            st.warning(f"⚠️ {len(fuzzy_matches)} well(s) matched by similar name only. Review them in the 'Diagnostics' tab.")
 
         # --- TABS ---
         tab1, tab2 = st.tabs(["📥 Download & Preview", "🔍 Diagnostics"])
@@ -280,16 +415,12 @@ if source_file and template_file:
         with tab1:
             st.subheader("Preview (Last 3 Rows)")
             # FIX: Convert to string for display to prevent PyArrow TypeError on mixed types
-            st.dataframe(final_df.tail(3).astype(str), use_container_width=True)
-            
-            buffer = io.BytesIO()
-            with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                # Write original data (numbers preserved) to Excel
-                final_df.to_excel(writer, index=False, header=False, sheet_name='Daily Production')
+            preview_df = pd.concat([df_tmpl.tail(2), new_row_df])
+            st.dataframe(preview_df.astype(str), use_container_width=True)
             
             st.download_button(
                 label="📥 Download Updated Master Excel",
-                data=buffer.getvalue(),
+                data=write_history_excel(df_tmpl, new_row_df),
                 file_name=f"Updated_History_{report_date.strftime('%Y-%m-%d')}.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                 type="primary"
@@ -304,6 +435,11 @@ if source_file and template_file:
                 st.write("**Target Wells (Master)**")
                 unique_target = sorted(list(set([x.split(" -> ")[0] for x in target_wells_debug])))
                 st.dataframe(pd.DataFrame(unique_target, columns=["Well Names Found"]), hide_index=True, use_container_width=True)
+            
+            if fuzzy_matches:
+                st.write("**Fuzzy Matches (check before saving)**")
+                fuzzy_df = pd.DataFrame(fuzzy_matches, columns=["Master Well", "Daily Well", "Score %"])
+                st.dataframe(fuzzy_df, hide_index=True, use_container_width=True)
 
 else:
     if not source_file and not template_file: